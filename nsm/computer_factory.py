@@ -5,7 +5,6 @@ from __future__ import print_function
 import json
 from collections import OrderedDict
 import re
-import copy
 import sys
 import os
 import nsm.data_utils as data_utils
@@ -329,7 +328,12 @@ class LispInterpreter(object):
             self.type_hierarchy, self.max_mem, self.max_n_exp, self.assisted)
 
         new.history = self.history[:]
-        new.exp_stack = copy.deepcopy(self.exp_stack)
+        # Only the currently open expressions (the elements of `exp_stack`)
+        # can still be appended to by `parse_step`; sub-expressions are
+        # immutable once popped into their parent. Sharing the closed parts
+        # between clones makes cloning O(open exps) instead of deep-copying
+        # the whole parse tree for every beam candidate.
+        new.exp_stack = [exp[:] for exp in self.exp_stack]
         new.n_exp = self.n_exp
         new.namespace = self.namespace.clone()
         return new
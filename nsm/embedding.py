@@ -40,11 +40,12 @@ class Embedder(nn.Module):
 class EmbeddingModel(object):
     def __init__(
             self, vocab_file, embedding_file, normalize_embeddings=True):
-        with open(embedding_file, 'rb') as f:
-            self.embedding_mat = np.load(f)
-        if normalize_embeddings:
-            self.embedding_mat = self.embedding_mat / np.linalg.norm(
-                self.embedding_mat, axis=1, keepdims=True)
+        # memory-map the matrix so only the rows actually looked up get paged
+        # in, instead of loading the full GloVe table into RAM up front;
+        # normalization happens per row at lookup time to keep the backing
+        # file read-only
+        self.embedding_mat = np.load(embedding_file, mmap_mode='r')
+        self.normalize_embeddings = normalize_embeddings
         with open(vocab_file, 'r') as f:
             tks = json.load(f)
         self.vocab = dict(zip(tks, range(len(tks))))
@@ -55,6 +56,10 @@ class EmbeddingModel(object):
     def __getitem__(self, word):
         if word in self.vocab:
             index = self.vocab[word]
-            return self.embedding_mat[index]
+            # copy the row out so callers never hold a view into the mmap
+            embedding = np.array(self.embedding_mat[index])
+            if self.normalize_embeddings:
+                embedding = embedding / np.linalg.norm(embedding)
+            return embedding
         else:
             raise KeyError
@@ -20,16 +20,16 @@ class Observation(object):
         self.output_features = output_features
         self.valid_action_mask = valid_action_mask
 
-    def to(self, device: torch.device):
+    def to(self, device: torch.device, non_blocking: bool = False):
         if self.read_ind.device == device:
             return self
 
-        self.read_ind = self.read_ind.to(device)
-        self.write_ind = self.write_ind.to(device)
+        self.read_ind = self.read_ind.to(device, non_blocking=non_blocking)
+        self.write_ind = self.write_ind.to(device, non_blocking=non_blocking)
         if self.valid_action_indices is not None:
-            self.valid_action_indices = self.valid_action_indices.to(device)
-        self.output_features = self.output_features.to(device)
-        self.valid_action_mask = self.valid_action_mask.to(device)
+            self.valid_action_indices = self.valid_action_indices.to(device, non_blocking=non_blocking)
+        self.output_features = self.output_features.to(device, non_blocking=non_blocking)
+        self.valid_action_mask = self.valid_action_mask.to(device, non_blocking=non_blocking)
 
         return self
 
@@ -62,8 +62,26 @@ class Observation(object):
 
         return valid_action_mask
 
+    # page-locked staging buffers reused by `to_batched_input` across decoding
+    # steps, keyed by (memory_size, feat_num) and grown to the largest batch
+    # seen; pinning host memory is expensive, so it is done once, not per step
+    _staging_buffers = {}
+
+    @classmethod
+    def _get_staging_buffers(cls, batch_size, memory_size, feat_num):
+        key = (memory_size, feat_num)
+        buffers = cls._staging_buffers.get(key)
+        if buffers is None or buffers[0].size(0) < batch_size:
+            buffers = (
+                torch.empty(batch_size, memory_size, feat_num, pin_memory=True),
+                torch.empty(batch_size, memory_size, pin_memory=True)
+            )
+            cls._staging_buffers[key] = buffers
+
+        return buffers[0][:batch_size], buffers[1][:batch_size]
+
     @staticmethod
-    def to_batched_input(obs: List['Observation'], memory_size) -> 'Observation':
+    def to_batched_input(obs: List['Observation'], memory_size, pin_memory=False) -> 'Observation':
         batch_size = len(obs)
 
         read_ind = torch.tensor([ob.read_ind for ob in obs])
@@ -71,17 +89,33 @@ class Observation(object):
 
         # pad output features
         feat_num = len(obs[0].output_features[0])
-        output_feats = np.zeros((batch_size, memory_size, feat_num), dtype=np.float32)
-        valid_action_mask = torch.zeros(batch_size, memory_size)
+        use_pinned = pin_memory and torch.cuda.is_available()
+
+        if use_pinned:
+            # fill the reusable page-locked buffers through numpy views so the
+            # subsequent `.to(device, non_blocking=True)` is an async DMA copy
+            # with no per-step host allocation
+            output_feats, valid_action_mask = Observation._get_staging_buffers(
+                batch_size, memory_size, feat_num)
+            output_feats_np = output_feats.numpy()
+            valid_action_mask_np = valid_action_mask.numpy()
+            output_feats_np[:] = 0.
+            valid_action_mask_np[:] = 0.
+
+            read_ind = read_ind.pin_memory()
+            write_ind = write_ind.pin_memory()
+        else:
+            output_feats_np = np.zeros((batch_size, memory_size, feat_num), dtype=np.float32)
+            valid_action_mask = torch.zeros(batch_size, memory_size)
+            valid_action_mask_np = valid_action_mask.numpy()
 
         for i, observation in enumerate(obs):
             if observation.valid_action_indices:
-                output_feats[i, observation.valid_action_indices] = observation.output_features
-                valid_action_mask[i, observation.valid_action_indices] = 1.
-
-        output_feats = torch.from_numpy(output_feats)
+                output_feats_np[i, observation.valid_action_indices] = observation.output_features
+                valid_action_mask_np[i, observation.valid_action_indices] = 1.
 
-        # valid_action_mask = Observation.get_valid_action_masks(obs, memory_size=memory_size)
+        if not use_pinned:
+            output_feats = torch.from_numpy(output_feats_np)
 
         return Observation(read_ind, write_ind, None, output_feats, valid_action_mask)
 
@@ -90,26 +124,61 @@ class Observation(object):
         batch_size = len(obs_seq)
         seq_len = max(len(ob_seq) for ob_seq in obs_seq)
 
-        read_ind = torch.zeros(batch_size, seq_len, dtype=torch.long)
-        write_ind = torch.zeros(batch_size, seq_len, dtype=torch.long).fill_(-1.)
-        valid_action_mask = torch.zeros(batch_size, seq_len, memory_size)
+        read_ind = np.zeros((batch_size, seq_len), dtype=np.int64)
+        write_ind = np.full((batch_size, seq_len), -1, dtype=np.int64)
+        valid_action_mask = np.zeros((batch_size, seq_len, memory_size), dtype=np.float32)
         feat_num = len(obs_seq[0][0].output_features[0])
         output_feats = np.zeros((batch_size, seq_len, memory_size, feat_num), dtype=np.float32)
 
-        for batch_id in range(batch_size):
-            ob_seq_i = obs_seq[batch_id]
-            for t in range(len(ob_seq_i)):
-                ob = obs_seq[batch_id][t]
+        # collect the (batch, t, action) coordinates of every valid action first,
+        # then fill the padded mask/feature tensors with one flat scatter each
+        # instead of a fancy-indexed assignment per token
+        flat_pos = []
+        flat_action_feats = []
+        for batch_id, ob_seq_i in enumerate(obs_seq):
+            for t, ob in enumerate(ob_seq_i):
                 read_ind[batch_id, t] = ob.read_ind
                 write_ind[batch_id, t] = ob.write_ind
 
-                valid_action_mask[batch_id, t, ob.valid_action_indices] = 1.
-                output_feats[batch_id, t, ob.valid_action_indices] = ob.output_features
+                if ob.valid_action_indices:
+                    action_ids = np.asarray(ob.valid_action_indices, dtype=np.int64)
+                    flat_pos.append((batch_id * seq_len + t) * memory_size + action_ids)
+                    flat_action_feats.append(np.asarray(ob.output_features, dtype=np.float32))
+
+        if flat_pos:
+            flat_pos = np.concatenate(flat_pos)
+            valid_action_mask.reshape(-1)[flat_pos] = 1.
+            output_feats.reshape(-1, feat_num)[flat_pos] = np.concatenate(flat_action_feats)
 
+        read_ind = torch.from_numpy(read_ind)
+        write_ind = torch.from_numpy(write_ind)
+        valid_action_mask = torch.from_numpy(valid_action_mask)
         output_feats = torch.from_numpy(output_feats)
 
         return Observation(read_ind, write_ind, None, output_feats, valid_action_mask)
 
+    def __getstate__(self):
+        # trajectories stream through multiprocessing queues between actors and
+        # the learner; packing the per-action Python lists into contiguous
+        # numpy arrays lets pickle ship raw buffers instead of serializing
+        # every int/float as a separate Python object
+        state = dict(self.__dict__)
+        if isinstance(state.get('valid_action_indices'), list):
+            state['valid_action_indices'] = np.asarray(state['valid_action_indices'], dtype=np.int32)
+        if isinstance(state.get('output_features'), list) and state['output_features']:
+            state['output_features'] = np.asarray(state['output_features'], dtype=np.float32)
+
+        return state
+
+    def __setstate__(self, state):
+        # restore the list representation the environments and batching code expect
+        if isinstance(state.get('valid_action_indices'), np.ndarray):
+            state['valid_action_indices'] = state['valid_action_indices'].tolist()
+        if isinstance(state.get('output_features'), np.ndarray):
+            state['output_features'] = state['output_features'].tolist()
+
+        self.__dict__.update(state)
+
     def __repr__(self):
         return f'Observation(read_id={repr(self.read_ind)}, write_id={repr(self.write_ind)}, ' \
             f'valid_actions={repr(self.valid_action_indices)})'
@@ -139,6 +208,20 @@ class Trajectory(object):
         self.human_readable_program = human_readable_program
 
         self._hash = hash((self.environment_name, ' '.join(str(a) for a in self.tgt_action_ids)))
+        self._sketch = None
+
+    def get_sketch(self):
+        """lazily construct (and memoize) the sketch of this trajectory's program
+
+        Trajectories are reused across replay steps, so rebuilding the sketch on
+        every forward pass repeats the tokenize/slot-classification work.
+        """
+        if self._sketch is None:
+            # local import to avoid a circular dependency with nsm.sketch
+            from nsm.sketch.sketch import Sketch
+            self._sketch = Sketch(self.program)
+
+        return self._sketch
 
     def __hash__(self):
         return self._hash
@@ -260,6 +343,7 @@ class QAProgrammingEnv(Environment):
         self.constants = constants
         self.punish_extra_work = punish_extra_work
         self.error = False
+        self._valid_action_index = None
         self.trigger_words_dict = trigger_words_dict
         tokens = question_annotation['tokens']
 
@@ -338,6 +422,19 @@ class QAProgrammingEnv(Environment):
     def get_context(self):
         return self.context
 
+    @property
+    def valid_action_index(self) -> Dict[int, int]:
+        """map from an absolute action id to its position in `valid_actions`
+
+        Built lazily and invalidated whenever `valid_actions` changes, so
+        resolving a sampled action id is O(1) instead of an O(N) `list.index`
+        scan in the agents' hot sampling loops.
+        """
+        if self._valid_action_index is None:
+            self._valid_action_index = {a: i for i, a in enumerate(self.valid_actions)}
+
+        return self._valid_action_index
+
     def step(self, action, debug=False):
         self.actions.append(action)
         if debug:
@@ -413,6 +510,7 @@ class QAProgrammingEnv(Environment):
             valid_actions = new_valid_actions
 
         self.valid_actions = valid_actions
+        self._valid_action_index = None
         self.rewards.append(reward)
         ob = Observation(read_ind=mapped_action,
                          write_ind=new_var_id,
@@ -467,6 +565,7 @@ class QAProgrammingEnv(Environment):
                     new_valid_actions.append(ma)
             valid_actions = new_valid_actions
         self.valid_actions = valid_actions
+        self._valid_action_index = None
         self.start_ob = Observation(self.de_vocab.decode_id,
                                     -1,
                                     valid_actions,
@@ -504,6 +603,8 @@ class QAProgrammingEnv(Environment):
         new.cache = self.cache
         new.use_cache = self.use_cache
         new.valid_actions = self.valid_actions
+        # `valid_actions` is shared with the clone, so its index map can be too
+        new._valid_action_index = self._valid_action_index
         new.start_ob = self.start_ob
         new.error = self.error
         new.id_feature_dict = self.id_feature_dict
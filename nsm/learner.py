@@ -63,6 +63,28 @@ class Learner(torch_mp.Process):
         agent_name = self.config.get('parser', 'vanilla')
         self.agent = get_parser_agent_by_name(agent_name).build(self.config, master='learner').to(self.devices[0]).train()
 
+        # when launched under torch.distributed (one learner process per GPU,
+        # each consuming its own shard of the training queue), run the
+        # forward/backward through DDP so gradient all-reduce overlaps with
+        # backward. `self.agent` stays the raw module for checkpointing and
+        # parameter-group construction.
+        self.ddp_agent = None
+        if self.config.get('use_ddp', False):
+            assert torch.distributed.is_available(), 'use_ddp is set but torch.distributed is unavailable'
+            if not torch.distributed.is_initialized():
+                # the learner is spawned as a plain process, so the group has
+                # to be set up here; init_process_group reads RANK/WORLD_SIZE/
+                # MASTER_ADDR/MASTER_PORT from the environment and fails
+                # loudly when the launcher did not provide them
+                torch.distributed.init_process_group(
+                    backend='nccl' if 'cuda' in self.devices[0].type else 'gloo',
+                    init_method='env://'
+                )
+            self.ddp_agent = torch.nn.parallel.DistributedDataParallel(
+                self.agent,
+                device_ids=[self.devices[0]] if 'cuda' in self.devices[0].type else None
+            )
+
         use_trainable_sketch_predictor = self.config.get('use_trainable_sketch_predictor', False)
         if use_trainable_sketch_predictor:
             assert len(self.devices) > 1
@@ -230,8 +252,10 @@ class Learner(torch_mp.Process):
     def train_step(self, train_samples, train_iter, summary_writer, reduction='sum'):
         train_trajectories = [sample.trajectory for sample in train_samples]
 
+        model = self.ddp_agent if getattr(self, 'ddp_agent', None) is not None else self.agent
+
         # (batch_size)
-        batch_log_prob, meta_info = self.agent(train_trajectories, return_info=True)
+        batch_log_prob = model(train_trajectories)
 
         train_sample_weights = batch_log_prob.new_tensor([s.weight for s in train_samples])
         batch_log_prob = batch_log_prob * train_sample_weights
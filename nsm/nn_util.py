@@ -138,6 +138,60 @@ def masked_log_softmax(vector: torch.Tensor, mask: torch.Tensor, dim: int = -1)
     return torch.nn.functional.log_softmax(vector, dim=dim)
 
 
+@torch.jit.script
+def masked_gather_logprob(logits: torch.Tensor,
+                          valid_action_mask: torch.Tensor,
+                          tgt_action_id: torch.Tensor,
+                          tgt_action_mask: torch.Tensor,
+                          variable_mask: torch.Tensor) -> torch.Tensor:
+    """
+    Fused equivalent of
+
+        log_probs = masked_log_softmax(logits, valid_action_mask)
+        (log_probs.gather(-1, tgt_action_id.unsqueeze(-1)).squeeze(-1)
+         * tgt_action_mask * variable_mask).sum(-1)
+
+    over ``(batch_size, max_action_len, memory_size)`` logits.  Scripting the whole
+    expression lets the JIT fuser merge the pointwise epilogue with the softmax
+    reduction, so the full log-prob tensor is never materialized.
+    """
+    # same masking trick as `masked_log_softmax`: log(mask + 1e-45) is a safe
+    # stand-in for -inf that avoids nans on fully-masked rows
+    masked_logits = logits + (valid_action_mask + 1e-45).log()
+    z = masked_logits - masked_logits.max(dim=-1, keepdim=True)[0]
+    log_norm = z.exp().sum(dim=-1).log()
+    tgt_z = z.gather(-1, tgt_action_id.unsqueeze(-1)).squeeze(-1)
+
+    return ((tgt_z - log_norm) * tgt_action_mask * variable_mask).sum(dim=-1)
+
+
+# decoding-only entry points run under this guard.  `torch.inference_mode`
+# would additionally skip view tracking, but tensors allocated under it stay
+# inference tensors forever: the pinned staging buffers cached on
+# `Observation` would be created inside `beam_search` and then reused by
+# grad-mode `sample()` calls, which inference tensors do not allow.  `no_grad`
+# has no such restriction, so stick with it
+inference_guard = torch.no_grad
+
+
+@torch.jit.script
+def masked_continuation_scores(action_logprobs: torch.Tensor,
+                               valid_action_mask: torch.Tensor,
+                               hyp_scores: torch.Tensor) -> torch.Tensor:
+    """
+    Fused equivalent of the beam-search scoring prologue
+
+        action_logprobs[(1 - valid_action_mask).bool()] = -inf
+        scores = action_logprobs + hyp_scores.unsqueeze(-1)
+
+    Scripting lets the fuser compute the -inf fill and the broadcast add in a
+    single pointwise kernel instead of writing the masked
+    ``(hyp_num, memory_size)`` tensor to memory twice.
+    """
+    return (action_logprobs.masked_fill(valid_action_mask < 0.5, float('-inf'))
+            + hyp_scores.unsqueeze(-1))
+
+
 def get_lengths_from_binary_sequence_mask(mask: torch.Tensor):
     """
     Compute sequence lengths for each batch element in a tensor using a
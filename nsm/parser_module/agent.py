@@ -1,7 +1,10 @@
 import collections
+import contextlib
+import heapq
 import math
 import sys
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 
 import torch
@@ -21,6 +24,20 @@ from nsm.parser_module.encoder import EncoderBase
 from nsm.sketch.sketch_predictor import SketchPredictor
 
 
+def clone_environments(environments: List[QAProgrammingEnv]) -> List[QAProgrammingEnv]:
+    """clone a batch of environments, fanning out to a thread pool for large batches
+
+    `env.clone()` calls are independent pure-Python work; for the duplicated
+    batches built in `sample` the serial loop is a measurable fraction of
+    sampling wall time.
+    """
+    if len(environments) < 16:
+        return [env.clone() for env in environments]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(lambda env: env.clone(), environments))
+
+
 class PGAgent(nn.Module):
     "Agent trained by policy gradient."
 
@@ -36,6 +53,17 @@ class PGAgent(nn.Module):
         self.encoder = encoder
         self.decoder = decoder
 
+        # `reduce-overhead` mode replays the compiled step through CUDA graphs,
+        # amortizing kernel launch overhead in the per-step sampling loops.
+        # The active batch shrinks as environments finish, so the default is
+        # dynamic-shape bucketing; runs that keep batch and beam size fixed
+        # (e.g. evaluation with a full beam) can set `compile_static_shapes`
+        # to capture a single graph and replay it without re-tracing.
+        if config.get('compile_decoder_step', False) and hasattr(torch, 'compile'):
+            self.decoder.step = torch.compile(
+                self.decoder.step, mode='reduce-overhead',
+                dynamic=not config.get('compile_static_shapes', False))
+
     @property
     def memory_size(self):
         return self.decoder.memory_size
@@ -51,6 +79,37 @@ class PGAgent(nn.Module):
     def encode(self, env_context):
         return self.encoder.encode(env_context)
 
+    def compact_active_rows(self, active_env_pos, state_t, sample_probs, encoding_slices):
+        """compact every per-row structure of a sampling loop to the surviving rows
+
+        `encoding_slices` maps each encoding dict to its row-indexed keys; the
+        dicts are updated in place and the compacted decoder state and sample
+        probabilities are returned. Driving all slicing through one shared
+        index tensor keeps the samplers' parallel arrays in sync and replaces
+        the per-sampler slicing blocks with a single operation.
+        """
+        active_env_idx = torch.as_tensor(
+            active_env_pos, dtype=torch.long, device=self.device)
+
+        for tensor_dict, keys in encoding_slices:
+            for key in keys:
+                tensor_dict[key] = tensor_dict[key].index_select(0, active_env_idx)
+
+        return state_t[active_env_idx], sample_probs.index_select(0, active_env_idx)
+
+    def decode_autocast(self):
+        """autocast context for the sampling/beam-search decode paths
+
+        These paths never backprop, so when `use_bf16_sampling` is set the
+        decoder steps run under bfloat16 autocast to halve activation
+        bandwidth. Logits are upcast to fp32 again before action sampling
+        and score accumulation.
+        """
+        if self.config.get('use_bf16_sampling', False) and self.device.type == 'cuda':
+            return torch.autocast('cuda', dtype=torch.bfloat16)
+
+        return contextlib.nullcontext()
+
     def compute_trajectory_actions_prob(self, trajectories: List[Trajectory], return_info=False) -> torch.Tensor:
         contexts = [traj.context for traj in trajectories]
         context_encoding = self.encoder.encode(contexts)
@@ -71,18 +130,31 @@ class PGAgent(nn.Module):
         tgt_action_mask = tgt_action_mask.to(self.device)
 
         max_time_step = batched_observation_seq.read_ind.size(1)
-        action_logits = []
+        action_logits = None
         for t in range(max_time_step):
             obs_slice_t = batched_observation_seq.slice(t)
 
             # mem_logits: (batch_size, memory_size)
             mem_logits, state_t = self.decoder.step(obs_slice_t, state_tm1, context_encoding)
 
-            action_logits.append(mem_logits)
+            if action_logits is None:
+                # write each step into a preallocated (batch_size, max_action_len,
+                # memory_size) buffer instead of stack + permute at the end
+                action_logits = torch.empty(
+                    mem_logits.size(0), max_time_step, self.memory_size,
+                    dtype=mem_logits.dtype, device=mem_logits.device
+                )
+
+            action_logits[:, t].copy_(mem_logits)
             state_tm1 = state_t
 
-        # (max_action_len, batch_size, memory_size)
-        action_logits = torch.stack(action_logits, dim=0).permute(1, 0, 2)
+        if not return_info:
+            # fused log-softmax + gather + masking; the full per-action log-prob
+            # tensor is never materialized.  The masks are binary, so reusing
+            # `tgt_action_mask` in the variable slot is a no-op
+            return nn_util.masked_gather_logprob(
+                action_logits, batched_observation_seq.valid_action_mask,
+                tgt_action_id, tgt_action_mask, tgt_action_mask)
 
         # (batch_size, max_action_len, memory_size)
         action_log_probs = nn_util.masked_log_softmax(action_logits, batched_observation_seq.valid_action_mask)
@@ -118,6 +190,11 @@ class PGAgent(nn.Module):
             return traj_log_prob.tolist()
 
     def forward(self, trajectories: List[Trajectory], entropy=False, return_info=False):
+        if not (entropy or return_info):
+            # fast path: lets `compute_trajectory_actions_prob` take its fused
+            # branch instead of materializing per-action info nobody reads
+            return self.compute_trajectory_actions_prob(trajectories)
+
         # (batch_size, max_action_len)
         traj_log_prob, meta_info = self.compute_trajectory_actions_prob(trajectories, return_info=True)
 
@@ -164,12 +241,11 @@ class PGAgent(nn.Module):
             # if already explored everything, then don't explore this environment anymore.
             environments = [env for env in environments if not env.cache.is_full()]
 
-        duplicated_envs = []
-        for env in environments:
-            for i in range(sample_num):
-                duplicated_envs.append(env.clone())
-
-        environments = duplicated_envs
+        environments = clone_environments([
+            env
+            for env in environments
+            for _ in range(sample_num)
+        ])
         for env in environments:
             env.use_cache = use_cache
 
@@ -184,9 +260,15 @@ class PGAgent(nn.Module):
         sample_probs = torch.zeros(len(environments), device=self.device)
 
         while True:
-            batched_ob_tm1 = Observation.to_batched_input(observations_tm1, memory_size=self.memory_size).to(
-                self.device)
-            mem_logits, state_t = self.decoder.step(observations_tm1, state_tm1, context_encoding=context_encoding)
+            batched_ob_tm1 = Observation.to_batched_input(
+                observations_tm1, memory_size=self.memory_size,
+                pin_memory=self.device.type == 'cuda'
+            ).to(self.device, non_blocking=True)
+            with self.decode_autocast():
+                # reuse the batch built above: batching the raw list again in
+                # `step` would refill the shared staging buffer while the copy
+                # of `batched_ob_tm1` may still be in flight
+                mem_logits, state_t = self.decoder.step(batched_ob_tm1, state_tm1, context_encoding=context_encoding)
 
             # try:
             # (batch_size)
@@ -202,7 +284,9 @@ class PGAgent(nn.Module):
             #     torch.save((mem_logits, batched_ob_tm1.valid_action_mask), 'tmp.bin')
             #     exit(-1)
 
-            sample_probs = sample_probs + sampled_action_t_prob
+            # in-place accumulation avoids reallocating the (batch_size,) tensor
+            # on every step
+            sample_probs.add_(sampled_action_t_prob)
 
             # print(sample_probs)
 
@@ -211,7 +295,7 @@ class PGAgent(nn.Module):
             new_active_envs = []
             has_completed_sample = False
             for env_id, (env, action_t) in enumerate(zip(active_envs, sampled_action_t_id.tolist())):
-                action_rel_id = env.valid_actions.index(action_t)
+                action_rel_id = env.valid_action_index[action_t]
                 ob_t, _, _, info = env.step(action_rel_id)
                 if env.done:
                     completed_envs.append((env, sample_probs[env_id].item()))
@@ -245,12 +329,10 @@ class PGAgent(nn.Module):
                 break
 
             if has_completed_sample:
-                # need to perform slicing
-                for key in self.sufficient_context_encoding_entries:
-                    context_encoding[key] = context_encoding[key][new_active_env_pos]
-
-                state_tm1 = state_t[new_active_env_pos]
-                sample_probs = sample_probs[new_active_env_pos]
+                state_tm1, sample_probs = self.compact_active_rows(
+                    new_active_env_pos, state_t, sample_probs,
+                    [(context_encoding, self.sufficient_context_encoding_entries)]
+                )
             else:
                 state_tm1 = state_t
 
@@ -265,6 +347,7 @@ class PGAgent(nn.Module):
 
         return samples
 
+    @nn_util.inference_guard()
     def new_beam_search(self, environments, beam_size, use_cache=False, return_list=False,
                         constraint_sketches=None, strict_constraint_on_sketches=False, force_sketch_coverage=False):
         if strict_constraint_on_sketches or force_sketch_coverage:
@@ -275,6 +358,11 @@ class PGAgent(nn.Module):
             # if already explored everything, then don't explore this environment anymore.
             environments = [env for env in environments if not env.cache.is_full()]
 
+            # every environment has an exhausted cache: nothing to search, so
+            # skip encoding and the whole decoding loop
+            if not environments:
+                return [] if return_list else OrderedDict()
+
         for env in environments:
             env.use_cache = use_cache
 
@@ -286,9 +374,12 @@ class PGAgent(nn.Module):
         # max_live_hyp_num = 1
         # live_beam_names = [env.name for env in environments]
 
-        beams = OrderedDict((env.name, [Hypothesis(env=env, score=0.)]) for env in environments)
+        # beams are positional (env_name, hypotheses) pairs; the per-step loop
+        # walks them in order, so there is no need to hash env names per access.
+        # Beams stay ragged and compact: only live hypotheses are batched into
+        # the decoder, so no -inf padding rows ever traverse the model
+        beams = [(env.name, [Hypothesis(env=env, score=0.)]) for env in environments]
         completed_hyps = OrderedDict((env.name, []) for env in environments)
-        # empty_hyp = dict(env=None, score=float('-inf'), ob=Observation.empty(), parent_beam_abs_pos=0)
 
         # (env_num, ...)
         env_context = [env.get_context() for env in environments]
@@ -308,32 +399,38 @@ class PGAgent(nn.Module):
         }
 
         while beams:
-            batched_ob_tm1 = Observation.to_batched_input(observations_tm1, memory_size=self.memory_size).to(
-                self.device)
+            batched_ob_tm1 = Observation.to_batched_input(
+                observations_tm1, memory_size=self.memory_size,
+                pin_memory=self.device.type == 'cuda'
+            ).to(self.device, non_blocking=True)
 
             # (hyp_num, memory_size)
-            action_probs_t, state_t = self.decoder.step_and_get_action_scores_t(batched_ob_tm1, state_tm1,
-                                                                                context_encoding=context_encoding_expanded)
-            action_probs_t[(1 - batched_ob_tm1.valid_action_mask).bool()] = float('-inf')
-
+            with self.decode_autocast():
+                action_probs_t, state_t = self.decoder.step_and_get_action_scores_t(batched_ob_tm1, state_tm1,
+                                                                                    context_encoding=context_encoding_expanded)
             # (hyp_num, memory_size)
-            cont_cand_hyp_scores = action_probs_t + hyp_scores_tm1.unsqueeze(-1)
-            cont_cand_hyp_scores = cont_cand_hyp_scores
+            cont_cand_hyp_scores = nn_util.masked_continuation_scores(
+                action_probs_t.float(),
+                batched_ob_tm1.valid_action_mask,
+                hyp_scores_tm1)
 
             # collect hypotheses
             beam_start = 0
-            continuing_candidates = OrderedDict()
-            new_beams = OrderedDict()
+            new_beams = []
 
             observations_t = []
             new_hyp_parent_abs_pos_list = []
-            new_hyp_scores = []
-            for env_name, beam in beams.items():
+            # flat positions of each surviving score inside cont_cand_hyp_scores,
+            # so the next step's scores are gathered on device instead of being
+            # re-uploaded from Python floats
+            new_hyp_score_flat_pos = []
+            for env_name, beam in beams:
                 live_beam_size = len(beam)
                 beam_end = beam_start + live_beam_size
                 # (beam_size, memory_size)
                 beam_new_cont_scores = cont_cand_hyp_scores[beam_start: beam_end]
-                continuing_candidates[env_name] = []
+                env_continuing_candidates = []
+                env_new_beam = []
 
                 for prev_hyp_id, prev_hyp in enumerate(beam):
                     _cont_action_scores = beam_new_cont_scores[prev_hyp_id][
@@ -360,13 +457,19 @@ class PGAgent(nn.Module):
                                 is_compatible = True
 
                             if is_compatible:
-                                continuing_candidates[env_name].append(candidate_hyp)
+                                env_continuing_candidates.append(candidate_hyp)
 
                 # rank all hypotheses together with completed ones
-                all_candidates = completed_hyps[env_name] + continuing_candidates[env_name]
-                all_candidates.sort(key=lambda hyp: hyp.score, reverse=True)
+                all_candidates = completed_hyps[env_name] + env_continuing_candidates
+                if force_sketch_coverage:
+                    # the coverage pass walks past the top-k, so it needs the
+                    # full ranking
+                    all_candidates.sort(key=lambda hyp: hyp.score, reverse=True)
+                else:
+                    # only the best beam_size candidates can enter the new beam;
+                    # partial selection is O(N log K) vs O(N log N) for the sort
+                    all_candidates = heapq.nlargest(beam_size, all_candidates, key=lambda hyp: hyp.score)
 
-                # top_k_candidates = heapq.nlargest(beam_size, all_candidates, key=lambda x: x.score)
                 completed_hyps[env_name] = []
 
                 def _add_hypothesis_to_new_beam(_hyp):
@@ -383,11 +486,12 @@ class PGAgent(nn.Module):
                                 completed_hyps[new_hyp_env.name].append(new_hyp)
                         else:
                             new_hyp = Hypothesis(env=new_hyp_env, score=_hyp.score)
-                            new_beams.setdefault(env_name, []).append(new_hyp)
+                            env_new_beam.append(new_hyp)
 
                             new_hyp_parent_abs_pos_list.append(_hyp.prev_hyp_abs_pos)
                             observations_t.append(ob_t)
-                            new_hyp_scores.append(_hyp.score)
+                            new_hyp_score_flat_pos.append(
+                                _hyp.prev_hyp_abs_pos * self.memory_size + _hyp.action_id)
 
                 new_beam_size = 0
                 if force_sketch_coverage:
@@ -439,28 +543,40 @@ class PGAgent(nn.Module):
                 #             observations_t.append(ob_t)
                 #             new_hyp_scores.append(cand_hyp.score)
 
+                if env_new_beam:
+                    new_beams.append((env_name, env_new_beam))
+
                 beam_start = beam_end
 
             if len(new_beams) == 0:
                 break
 
-            new_hyp_state_t = [(s[0][new_hyp_parent_abs_pos_list], s[1][new_hyp_parent_abs_pos_list]) for s in
-                               state_t.state]
-            new_hyp_memory_t = state_t.memory[new_hyp_parent_abs_pos_list]
+            # one device index tensor shared by the state, memory and encoding
+            # gathers, instead of re-coercing the Python list per gather.
+            # Hypotheses with a common parent share that parent's state through
+            # this gather; the per-row LSTM inputs that follow are all distinct
+            # since a beam never contains two (parent, action) duplicates, so
+            # there is no further prefix-level work to deduplicate
+            parent_idx = torch.as_tensor(
+                new_hyp_parent_abs_pos_list, dtype=torch.long, device=self.device)
+            new_hyp_state_t = [(s[0].index_select(0, parent_idx), s[1].index_select(0, parent_idx))
+                               for s in state_t.state]
+            new_hyp_memory_t = state_t.memory.index_select(0, parent_idx)
 
             state_tm1 = DecoderState(state=new_hyp_state_t, memory=new_hyp_memory_t)
             observations_tm1 = observations_t
-            hyp_scores_tm1 = torch.tensor(new_hyp_scores, device=self.device)
+            hyp_scores_tm1 = cont_cand_hyp_scores.view(-1).index_select(
+                0, torch.as_tensor(new_hyp_score_flat_pos, dtype=torch.long, device=self.device))
 
             for key in self.sufficient_context_encoding_entries:
-                context_encoding_expanded[key] = context_encoding_expanded[key][new_hyp_parent_abs_pos_list]
+                context_encoding_expanded[key] = context_encoding_expanded[key].index_select(0, parent_idx)
 
             beams = new_beams
 
         if not return_list:
             # rank completed hypothesis
             for env_name in completed_hyps.keys():
-                sorted_hyps = sorted(completed_hyps[env_name], key=lambda hyp: hyp.score, reverse=True)[:beam_size]
+                sorted_hyps = heapq.nlargest(beam_size, completed_hyps[env_name], key=lambda hyp: hyp.score)
                 completed_hyps[env_name] = [
                     Sample(
                         trajectory=Trajectory.from_environment(hyp.env),
@@ -527,10 +643,18 @@ class PGAgent(nn.Module):
         """
 
         # p_actions = nn_util.masked_softmax(logits, mask=valid_action_mask)
+        # upcast in case the decoder stepped under bf16 autocast; categorical
+        # sampling is done in full precision
+        logits = logits.float()
         logits.masked_fill_((1 - valid_action_mask).bool(), -math.inf)
-        p_actions = F.softmax(logits, dim=-1)
+
+        # Gumbel-max sampling: argmax over perturbed logits draws from the
+        # same categorical distribution as softmax + multinomial, with one
+        # elementwise pass and one reduction instead of a CDF scan per row
+        u = torch.empty_like(logits).uniform_().clamp_min_(1e-20)
+        gumbel_noise = -torch.log(-torch.log(u))
         # (batch_size, 1)
-        sampled_actions = torch.multinomial(p_actions, num_samples=1)
+        sampled_actions = (logits + gumbel_noise).argmax(dim=-1, keepdim=True)
 
         if return_log_prob:
             log_p_actions = nn_util.masked_log_softmax(logits, mask=valid_action_mask)
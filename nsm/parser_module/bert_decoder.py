@@ -160,7 +160,10 @@ class BertDecoder(DecoderBase):
 
         # first convert listed input to batched ones
         if isinstance(x, list):
-            x = Observation.to_batched_input(x, memory_size=self.memory_size).to(self.device)
+            x = Observation.to_batched_input(
+                x, memory_size=self.memory_size,
+                pin_memory=self.device.type == 'cuda'
+            ).to(self.device, non_blocking=True)
 
         batch_size = x.read_ind.size(0)
 
@@ -185,6 +185,10 @@ class BertEncoder(EncoderBase):
                 dim=-1)
 
         question_encoding = self.bert_output_project(question_encoding)
+        # attention keys over the (static) question are projected once here;
+        # decoders attend against this cached tensor every step instead of
+        # re-projecting the question encoding, and the attention values are
+        # the unprojected encodings, so no per-step projection remains
         question_encoding_att_linear = self.question_encoding_att_value_to_key(question_encoding)
 
         context_encoding = {
@@ -1,5 +1,6 @@
 import collections
 
+import torch
 from torch import nn as nn
 
 
@@ -68,7 +69,19 @@ class DecoderState(object):
         self.memory = memory
 
     def __getitem__(self, indices):
-        sliced_state = [(s[0][indices], s[1][indices]) for s in self.state]
+        num_layers = len(self.state)
+        if num_layers > 1:
+            # gather every layer's (h, c) through one stacked view so beam
+            # reordering launches a single index kernel instead of one per
+            # state tensor
+            stacked = torch.stack([s for layer in self.state for s in layer])
+            sliced = stacked[:, indices]
+            sliced_state = [
+                (sliced[2 * i], sliced[2 * i + 1])
+                for i in range(num_layers)
+            ]
+        else:
+            sliced_state = [(s[0][indices], s[1][indices]) for s in self.state]
         sliced_memory = self.memory[indices]
 
         return DecoderState(sliced_state, sliced_memory)
\ No newline at end of file
@@ -1,4 +1,5 @@
 import collections
+import heapq
 import math
 import sys
 from collections import OrderedDict
@@ -11,7 +12,7 @@ from torch import nn as nn
 import nsm.execution.worlds.wikitablequestions
 from nsm import nn_util, data_utils
 from nsm.execution import executor_factory
-from nsm.parser_module.agent import PGAgent
+from nsm.parser_module.agent import PGAgent, clone_environments
 from nsm.computer_factory import SPECIAL_TKS
 from nsm.env_factory import Trajectory, Observation, Sample
 from nsm.parser_module.bert_encoder import BertEncoder
@@ -47,9 +48,52 @@ class SketchGuidedAgent(PGAgent):
 
         self.log = log
 
+        # optionally compile the whole decoder unroll so pointwise ops are fused
+        # across time steps and kernel launch overhead is amortized
+        self._unroll_decoder_fn = self._unroll_decoder
+        if config.get('compile_decoder_unroll', False) and hasattr(torch, 'compile'):
+            self._unroll_decoder_fn = torch.compile(
+                self._unroll_decoder,
+                mode='reduce-overhead', fullgraph=False, dynamic=True
+            )
+
+    def _unroll_decoder(self, batched_observation_seq, init_state, context_encoding, sketch_encoding):
+        """run the decoder over the whole batched observation sequence
+
+        The per-timestep loop is factored out of `compute_trajectory_actions_prob`
+        so it can be handed to `torch.compile` as one unit (see `__init__`)
+        """
+        state_tm1 = init_state
+        max_time_step = batched_observation_seq.read_ind.size(1)
+        action_logits = None
+        for t in range(max_time_step):
+            obs_slice_t = batched_observation_seq.slice(t)
+
+            # mem_logits: (batch_size, memory_size)
+            mem_logits, state_t = self.decoder.step(
+                obs_slice_t,
+                state_tm1,
+                context_encoding,
+                sketch_encoding
+            )
+
+            if action_logits is None:
+                # write each step into a preallocated (batch_size, max_action_len,
+                # memory_size) buffer instead of stack + permute at the end;
+                # lazily initialized to pick up the decoder output's dtype
+                action_logits = torch.empty(
+                    mem_logits.size(0), max_time_step, self.memory_size,
+                    dtype=mem_logits.dtype, device=mem_logits.device
+                )
+
+            action_logits[:, t].copy_(mem_logits)
+            state_tm1 = state_t
+
+        return action_logits
+
     def compute_trajectory_actions_prob(self, trajectories: List[Trajectory], return_info=False) -> torch.Tensor:
         contexts = [traj.context for traj in trajectories]
-        sketches = [Sketch(traj.program) for traj in trajectories]
+        sketches = [traj.get_sketch() for traj in trajectories]
 
         sketch_prob = self.sketch_predictor(
             contexts,
@@ -63,7 +107,7 @@ class SketchGuidedAgent(PGAgent):
 
         sketch_encoding = self.sketch_encoder(sketches)
 
-        state_tm1 = init_state = self.decoder.get_initial_state(context_encoding, sketch_encoding)
+        init_state = self.decoder.get_initial_state(context_encoding, sketch_encoding)
 
         # moved to device
         batched_observation_seq.to(self.device)
@@ -76,24 +120,21 @@ class SketchGuidedAgent(PGAgent):
         tgt_action_id = tgt_action_id.to(self.device)
         tgt_action_mask = tgt_action_mask.to(self.device)
 
-        max_time_step = batched_observation_seq.read_ind.size(1)
-        action_logits = []
-        for t in range(max_time_step):
-            obs_slice_t = batched_observation_seq.slice(t)
+        # (batch_size, max_action_len, memory_size)
+        action_logits = self._unroll_decoder_fn(
+            batched_observation_seq, init_state, context_encoding, sketch_encoding)
 
-            # mem_logits: (batch_size, memory_size)
-            mem_logits, state_t = self.decoder.step(
-                obs_slice_t,
-                state_tm1,
-                context_encoding,
-                sketch_encoding
-            )
+        # (batch_size, max_action_len)
+        variable_ground_mask = sketch_encoding['var_time_step_mask']
 
-            action_logits.append(mem_logits)
-            state_tm1 = state_t
+        if not return_info:
+            # fused log-softmax + gather + masking; the full per-action log-prob
+            # tensor is never materialized
+            tgt_trajectory_log_probs = sketch_prob + nn_util.masked_gather_logprob(
+                action_logits, batched_observation_seq.valid_action_mask,
+                tgt_action_id, tgt_action_mask, variable_ground_mask)
 
-        # (max_action_len, batch_size, memory_size)
-        action_logits = torch.stack(action_logits, dim=0).permute(1, 0, 2)
+            return tgt_trajectory_log_probs
 
         # (batch_size, max_action_len, memory_size)
         action_log_probs = nn_util.masked_log_softmax(action_logits, batched_observation_seq.valid_action_mask)
@@ -102,7 +143,6 @@ class SketchGuidedAgent(PGAgent):
         tgt_action_log_probs = torch.gather(action_log_probs, dim=-1, index=tgt_action_id.unsqueeze(-1)).squeeze(-1) * tgt_action_mask
 
         # (batch_size, max_action_len)
-        variable_ground_mask = sketch_encoding['var_time_step_mask']
         tgt_variable_grounding_prob = tgt_action_log_probs * variable_ground_mask
 
         # (batch_size)
@@ -144,20 +184,35 @@ class SketchGuidedAgent(PGAgent):
         sketches = []
         duplicated_envs = []
 
-        for env_idx, env in enumerate(environments):
+        sample_temp = self.config.get('sketch_sample_temperature', 1.)
+
+        # draw sketch indices for all environments with one batched multinomial
+        # call instead of a per-env numpy softmax + np.random.choice
+        sketchful_env_indices = [
+            env_idx for env_idx, env_sketches in enumerate(batch_env_sketches)
+            if env_sketches
+        ]
+        if not sketchful_env_indices:
+            return []
+
+        max_sketch_num = max(len(batch_env_sketches[env_idx]) for env_idx in sketchful_env_indices)
+        # (env_num, max_sketch_num), padded with -inf so padding gets zero probability
+        sketch_scores = torch.full((len(sketchful_env_indices), max_sketch_num), float('-inf'))
+        for row, env_idx in enumerate(sketchful_env_indices):
             env_sketches = batch_env_sketches[env_idx]
-            if not env_sketches:
-                continue
+            sketch_scores[row, :len(env_sketches)] = torch.tensor(
+                [sketch.prob / sample_temp for sketch in env_sketches])
 
-            sample_temp = self.config.get('sketch_sample_temperature', 1.)
-            env_probs = np.exp([sketch.prob / sample_temp for sketch in env_sketches])
-            env_probs /= env_probs.sum()
+        sketch_probs = torch.softmax(sketch_scores.to(self.device), dim=-1)
+        # (env_num, sample_num)
+        batch_sampled_sketch_indices = torch.multinomial(
+            sketch_probs, sample_num, replacement=True).cpu().tolist()
 
-            sampled_sketch_indices = np.random.choice(
-                list(range(len(env_sketches))),
-                size=sample_num, replace=True,
-                p=env_probs
-            )
+        for row, env_idx in enumerate(sketchful_env_indices):
+            env = environments[env_idx]
+            env_sketches = batch_env_sketches[env_idx]
+
+            sampled_sketch_indices = batch_sampled_sketch_indices[row]
             sampled_sketches = [env_sketches[idx] for idx in sampled_sketch_indices]
 
             if self.log:
@@ -171,15 +226,12 @@ class SketchGuidedAgent(PGAgent):
                     print(sketch, file=self.log)
 
             sketches.extend(sampled_sketches)
-            duplicated_envs.extend([
-                env.clone()
-                for _ in range(len(sampled_sketches))
-            ])
+            duplicated_envs.extend([env] * len(sampled_sketches))
 
         if not duplicated_envs:
             return []
 
-        environments = duplicated_envs
+        environments = clone_environments(duplicated_envs)
         for env in environments:
             env.use_cache = use_cache
 
@@ -195,13 +247,20 @@ class SketchGuidedAgent(PGAgent):
         sample_probs = torch.zeros(len(environments), device=self.device)
 
         while True:
-            batched_ob_tm1 = Observation.to_batched_input(observations_tm1, memory_size=self.memory_size).to(self.device)
-            mem_logits, state_t = self.decoder.step(
-                observations_tm1,
-                state_tm1,
-                context_encoding,
-                sketch_encoding
-            )
+            batched_ob_tm1 = Observation.to_batched_input(
+                observations_tm1, memory_size=self.memory_size,
+                pin_memory=self.device.type == 'cuda'
+            ).to(self.device, non_blocking=True)
+            with self.decode_autocast():
+                # reuse the batch built above: batching the raw list again in
+                # `step` would refill the shared staging buffer while the copy
+                # of `batched_ob_tm1` may still be in flight
+                mem_logits, state_t = self.decoder.step(
+                    batched_ob_tm1,
+                    state_tm1,
+                    context_encoding,
+                    sketch_encoding
+                )
 
             # try:
             # (batch_size)
@@ -218,7 +277,9 @@ class SketchGuidedAgent(PGAgent):
             #     exit(-1)
 
             variable_mask = sketch_encoding['var_time_step_mask'][:, state_tm1.t]
-            sample_probs = sample_probs + sampled_action_t_prob * variable_mask
+            # in-place accumulation avoids reallocating the (batch_size,) tensor
+            # on every step
+            sample_probs.add_(sampled_action_t_prob * variable_mask)
 
             observations_t = []
             new_active_env_pos = []
@@ -234,7 +295,7 @@ class SketchGuidedAgent(PGAgent):
                     raise ValueError()
 
                 sketch_token_tm1 = sketch[state_t.t - 1]
-                if not sketch.is_variable_slot(sketch_token_tm1):
+                if not sketch.variable_slot_mask[state_t.t - 1]:
                     # ues sketch's predefined action instead of the sampled one
                     sketch_action_t = env.de_vocab.lookup(sketch_token_tm1)
                     # if sketch token not in valid continuating actions
@@ -248,13 +309,15 @@ class SketchGuidedAgent(PGAgent):
 
                     action_t = sketch_action_t
 
-                if action_t in env.valid_actions:
-                    action_rel_id = env.valid_actions.index(action_t)
+                if action_t in env.valid_action_index:
+                    action_rel_id = env.valid_action_index[action_t]
                     ob_t, _, _, info = env.step(action_rel_id)
                     if env.done:
+                        # keep the probability as a scalar tensor for now;
+                        # calling `.item()` here would force a GPU sync per sample
                         completed_envs.append((
                             env,
-                            sketch.prob + sample_probs[env_id].item()
+                            sketch.prob + sample_probs[env_id]
                         ))
                         has_completed_sample = True
                     else:
@@ -262,21 +325,20 @@ class SketchGuidedAgent(PGAgent):
                         new_active_env_pos.append(env_id)
                         new_active_envs.append(env)
                 else:
-                    assert sketch_action_t not in env.valid_actions
+                    assert sketch_action_t not in env.valid_action_index
                     has_completed_sample = True
 
             if not new_active_env_pos:
                 break
 
             if has_completed_sample:
-                # need to perform slicing
-                for key in ['question_encoding', 'question_mask', 'question_encoding_att_linear']:
-                    context_encoding[key] = context_encoding[key][new_active_env_pos]
-                for key in ['var_time_step_mask', 'value']:
-                    sketch_encoding[key] = sketch_encoding[key][new_active_env_pos]
-
-                state_tm1 = state_t[new_active_env_pos]
-                sample_probs = sample_probs[new_active_env_pos]
+                state_tm1, sample_probs = self.compact_active_rows(
+                    new_active_env_pos, state_t, sample_probs,
+                    [
+                        (context_encoding, ['question_encoding', 'question_mask', 'question_encoding_att_linear']),
+                        (sketch_encoding, ['var_time_step_mask', 'value'])
+                    ]
+                )
                 sketches = [sketches[i] for i in new_active_env_pos]
             else:
                 state_tm1 = state_t
@@ -291,13 +353,14 @@ class SketchGuidedAgent(PGAgent):
         for env_id, (env, prob) in enumerate(completed_envs):
             if not env.error:
                 traj = Trajectory.from_environment(env)
-                samples.append(Sample(trajectory=traj, prob=prob))
+                samples.append(Sample(trajectory=traj, prob=prob.item()))
 
                 # if self.log:
                 #     print(f"{' '.join(traj.human_readable_program)} (correct={traj.reward == 1.}, prob={prob})", file=self.log)
 
         return samples
 
+    @nn_util.inference_guard()
     def new_beam_search(self, environments, beam_size, use_cache=False, return_list=False,
                         constraint_sketches=None, strict_constraint_on_sketches=False, force_sketch_coverage=False):
         # if already explored everything, then don't explore this environment anymore.
@@ -305,6 +368,11 @@ class SketchGuidedAgent(PGAgent):
             # if already explored everything, then don't explore this environment anymore.
             environments = [env for env in environments if not env.cache.is_full()]
 
+            # every environment has an exhausted cache: nothing to search, so
+            # skip sketch prediction, encoding and the whole decoding loop
+            if not environments:
+                return [] if return_list else OrderedDict()
+
         for env in environments:
             env.use_cache = use_cache
 
@@ -323,12 +391,17 @@ class SketchGuidedAgent(PGAgent):
                 ]
 
             for key in keys:
-                sliced_tensor = _tensor_dict[key][indices]
+                if torch.is_tensor(indices):
+                    sliced_tensor = _tensor_dict[key].index_select(0, indices)
+                else:
+                    sliced_tensor = _tensor_dict[key][indices]
                 _tensor_dict[key] = sliced_tensor
 
             return _tensor_dict
 
-        beams = OrderedDict()
+        # beams are positional (env_name, hypotheses) pairs; the per-step loop
+        # walks them in order, so there is no need to hash env names per access
+        beams = []
         completed_hyps = OrderedDict((env.name, []) for env in environments)
 
         # (env_num, ...)
@@ -358,12 +431,12 @@ class SketchGuidedAgent(PGAgent):
             hyp_sketches.extend(env_hyp_sketches)
 
             # clone each environment while adding them to the initial beam
-            beams[env.name] = [
+            beams.append((env.name, [
                 # hypothesis is initialized with sketch's probability
                 Hypothesis(sketch=sketch, env=env.clone(), score=sketch.prob)
                 for sketch
                 in env_hyp_sketches
-            ]
+            ]))
 
             flattened_hyp_env_idx_ptr.extend([i] * env_sketch_num)
 
@@ -372,7 +445,7 @@ class SketchGuidedAgent(PGAgent):
 
         def _log_beam(_beams):
             print("Current Beam Configuration:", file=self.log)
-            for env_name, beam in _beams.items():
+            for env_name, beam in _beams:
                 print(f"======[{env_name}]======", file=self.log)
                 for hyp in beam:
                     program = hyp.env.to_human_readable_program()
@@ -390,7 +463,7 @@ class SketchGuidedAgent(PGAgent):
         # (hyp_num, xxx)
         observations_tm1 = [
             hyp.env.start_ob
-            for env_name, beam in beams.items()
+            for env_name, beam in beams
             for hyp in beam
         ]
 
@@ -403,7 +476,7 @@ class SketchGuidedAgent(PGAgent):
         hyp_scores_tm1 = torch.tensor(
             [
                 hyp.score
-                for beam in beams.values()
+                for _, beam in beams
                 for hyp in beam
             ], device=self.device
         )
@@ -412,14 +485,19 @@ class SketchGuidedAgent(PGAgent):
             if self.log:
                 print(f't={state_tm1.t}', file=self.log)
 
-            batched_ob_tm1 = Observation.to_batched_input(observations_tm1, memory_size=self.memory_size).to(self.device)
+            batched_ob_tm1 = Observation.to_batched_input(
+                observations_tm1, memory_size=self.memory_size,
+                pin_memory=self.device.type == 'cuda'
+            ).to(self.device, non_blocking=True)
 
             # (hyp_num, memory_size)
-            action_probs_t, state_t = self.decoder.step_and_get_action_scores_t(
-                batched_ob_tm1, state_tm1,
-                context_encoding=context_encoding_expanded,
-                sketch_encoding=sketch_encoding_expanded
-            )
+            with self.decode_autocast():
+                action_probs_t, state_t = self.decoder.step_and_get_action_scores_t(
+                    batched_ob_tm1, state_tm1,
+                    context_encoding=context_encoding_expanded,
+                    sketch_encoding=sketch_encoding_expanded
+                )
+            action_probs_t = action_probs_t.float()
 
             # no need to -inf over invalid slots, since we will only enumerate over
             # valid entries later
@@ -431,20 +509,24 @@ class SketchGuidedAgent(PGAgent):
             # (hyp_num, memory_size)
             cont_cand_hyp_scores = action_probs_t + hyp_scores_tm1.unsqueeze(-1)
 
+            # one device-to-host transfer per step; the per-hypothesis enumeration
+            # below then reads plain numpy floats without any GPU sync
+            cont_cand_hyp_scores_np = cont_cand_hyp_scores.cpu().numpy()
+
             # collect continuating candidates for new hypotheses
             beam_start = 0
-            continuing_candidates = OrderedDict()
-            new_beams = OrderedDict()
+            new_beams = []
 
             observations_t = []
             new_hyp_parent_abs_pos_list = []
             new_hyp_scores = []
-            for env_name, beam in beams.items():
+            for env_name, beam in beams:
                 live_beam_size = len(beam)
                 beam_end = beam_start + live_beam_size
                 # (beam_size, memory_size)
-                beam_new_cont_scores = cont_cand_hyp_scores[beam_start: beam_end]
-                continuing_candidates[env_name] = []
+                beam_new_cont_scores = cont_cand_hyp_scores_np[beam_start: beam_end]
+                env_continuing_candidates = []
+                env_new_beam = []
 
                 if self.log:
                     print(f"Question[{env_name}] {live_beam_size} living hyps", file=self.log)
@@ -457,45 +539,46 @@ class SketchGuidedAgent(PGAgent):
                         print(f"\tHyp: sketch={prev_hyp.sketch} program={prev_hyp.env.program} Sketch token={sketch_token} Score={prev_hyp.score}", file=self.log)
 
                     # if it is a variable grounding step
-                    if hyp_sketch.is_variable_slot(sketch_token):
+                    if hyp_sketch.variable_slot_mask[state_tm1.t]:
                         if self.log:
                             print(f"\tvariable grounding", file=self.log)
 
                         valid_action_indices = prev_hyp.env.valid_actions
                         _cont_action_scores = beam_new_cont_scores[prev_hyp_id][
-                            valid_action_indices].cpu()
+                            valid_action_indices]
 
-                        for rel_action_id, new_hyp_score in enumerate(_cont_action_scores):
+                        # skip infeasible candidates without Python branching
+                        for rel_action_id in np.flatnonzero(np.isfinite(_cont_action_scores)):
+                            rel_action_id = int(rel_action_id)
                             abs_action_id = prev_hyp.env.obs[-1].valid_action_indices[rel_action_id]
-                            new_hyp_score = new_hyp_score.item()
-                            if not math.isinf(new_hyp_score):
-                                if self.log:
-                                    action_token = prev_hyp.env.de_vocab.lookup(abs_action_id, reverse=True)
-                                    human_readable_token = prev_hyp.env.get_human_readable_action_token(action_token)
-                                else:
-                                    human_readable_token = None
-
-                                candidate_hyp = CandidateHyp(
-                                    sketch=prev_hyp.sketch,
-                                    prev_hyp_env=prev_hyp.env,
-                                    rel_action_id=rel_action_id,
-                                    action_id=abs_action_id,
-                                    score=new_hyp_score,
-                                    prev_hyp_abs_pos=beam_start + prev_hyp_id,
-                                    human_action_token=human_readable_token
-                                )
-
-                                if self.log:
-                                    print(f"\t\tvar={candidate_hyp.human_action_token} align score={new_hyp_score - prev_hyp.score}", file=self.log)
-
-                                continuing_candidates[env_name].append(candidate_hyp)
+                            new_hyp_score = float(_cont_action_scores[rel_action_id])
+                            if self.log:
+                                action_token = prev_hyp.env.de_vocab.lookup(abs_action_id, reverse=True)
+                                human_readable_token = prev_hyp.env.get_human_readable_action_token(action_token)
+                            else:
+                                human_readable_token = None
+
+                            candidate_hyp = CandidateHyp(
+                                sketch=prev_hyp.sketch,
+                                prev_hyp_env=prev_hyp.env,
+                                rel_action_id=rel_action_id,
+                                action_id=abs_action_id,
+                                score=new_hyp_score,
+                                prev_hyp_abs_pos=beam_start + prev_hyp_id,
+                                human_action_token=human_readable_token
+                            )
+
+                            if self.log:
+                                print(f"\t\tvar={candidate_hyp.human_action_token} align score={new_hyp_score - prev_hyp.score}", file=self.log)
+
+                            env_continuing_candidates.append(candidate_hyp)
                     else:
                         # if it is an idle run step (encode sketch token)
                         abs_action_id = prev_hyp.env.de_vocab.lookup(sketch_token)
-                        valid_action_indices = prev_hyp.env.valid_actions
-                        if abs_action_id in valid_action_indices:
-                            rel_action_id = valid_action_indices.index(abs_action_id)
-
+                        # O(1) membership and position lookup via the env's
+                        # cached reverse map instead of scanning valid_actions
+                        rel_action_id = prev_hyp.env.valid_action_index.get(abs_action_id)
+                        if rel_action_id is not None:
                             candidate_hyp = CandidateHyp(
                                 sketch=prev_hyp.sketch,
                                 prev_hyp_env=prev_hyp.env,
@@ -505,14 +588,21 @@ class SketchGuidedAgent(PGAgent):
                                 prev_hyp_abs_pos=beam_start + prev_hyp_id,
                                 human_action_token=sketch_token
                             )
-                            continuing_candidates[env_name].append(candidate_hyp)
+                            env_continuing_candidates.append(candidate_hyp)
 
                             if self.log:
                                 print(f"\t\tIdle run, use sketch token", file=self.log)
 
                 # rank all hypotheses together with completed ones
-                all_candidates = completed_hyps[env_name] + continuing_candidates[env_name]
-                all_candidates.sort(key=lambda hyp: hyp.score, reverse=True)
+                all_candidates = completed_hyps[env_name] + env_continuing_candidates
+                if force_sketch_coverage or self.log:
+                    # coverage walks past the top-k and logging prints the full
+                    # ranking, so keep the complete sort in those modes
+                    all_candidates.sort(key=lambda hyp: hyp.score, reverse=True)
+                else:
+                    # only the best beam_size candidates can enter the new beam;
+                    # partial selection is O(N log K) vs O(N log N) for the sort
+                    all_candidates = heapq.nlargest(beam_size, all_candidates, key=lambda hyp: hyp.score)
 
                 if self.log:
                     print(f"Ranked hypothesis:", file=self.log)
@@ -542,7 +632,7 @@ class SketchGuidedAgent(PGAgent):
                                 completed_hyps[new_hyp_env.name].append(new_hyp)
                         else:
                             new_hyp = Hypothesis(env=new_hyp_env, score=_hyp.score, sketch=_hyp.sketch)
-                            new_beams.setdefault(env_name, []).append(new_hyp)
+                            env_new_beam.append(new_hyp)
 
                             new_hyp_parent_abs_pos_list.append(_hyp.prev_hyp_abs_pos)
                             observations_t.append(ob_t)
@@ -557,29 +647,21 @@ class SketchGuidedAgent(PGAgent):
                         _add_hypothesis_to_new_beam(cand_hyp)
 
                         if force_sketch_coverage:
-                            cand_hyp_covered_sketches = set(
-                                sketch
-                                for sketch
-                                in env_new_beam_not_covered_sketches
-                                if sketch == cand_hyp.sketch
-                            )
-                            env_new_beam_not_covered_sketches -= cand_hyp_covered_sketches
+                            # sketches hash on their token string, so covering a
+                            # candidate's sketch is a single O(1) discard
+                            env_new_beam_not_covered_sketches.discard(cand_hyp.sketch)
 
                     # make sure each sketch has at least one candidate hypothesis in the new beam
                     elif force_sketch_coverage and env_new_beam_not_covered_sketches:
-                        cand_hyp_covered_sketches = set(
-                            sketch
-                            for sketch
-                            in env_new_beam_not_covered_sketches
-                            if sketch == cand_hyp.sketch
-                        )
-
-                        if cand_hyp_covered_sketches:
+                        if cand_hyp.sketch in env_new_beam_not_covered_sketches:
                             _add_hypothesis_to_new_beam(cand_hyp)
-                            env_new_beam_not_covered_sketches -= cand_hyp_covered_sketches
+                            env_new_beam_not_covered_sketches.discard(cand_hyp.sketch)
 
                     new_beam_size += 1
 
+                if env_new_beam:
+                    new_beams.append((env_name, env_new_beam))
+
                 beam_start = beam_end
 
             if len(new_beams) == 0:
@@ -588,18 +670,27 @@ class SketchGuidedAgent(PGAgent):
             if self.log:
                 _log_beam(new_beams)
 
-            state_tm1 = state_t[new_hyp_parent_abs_pos_list]
+            # one device index tensor shared by the state and both encoding
+            # gathers, instead of re-coercing the Python list per gather
+            parent_idx = torch.as_tensor(
+                new_hyp_parent_abs_pos_list, dtype=torch.long, device=self.device)
+            state_tm1 = state_t[parent_idx]
             observations_tm1 = observations_t
-            hyp_scores_tm1 = torch.tensor(new_hyp_scores, device=self.device)
+            # idle-run candidates reuse their parent's score, which never
+            # enters the masked score matrix, so the scores are shipped from
+            # the host; staging through numpy avoids the slow per-element
+            # conversion of a Python list
+            hyp_scores_tm1 = torch.from_numpy(
+                np.asarray(new_hyp_scores, dtype=np.float32)).to(self.device)
 
             _expand_encoding(
                 context_encoding_expanded,
-                new_hyp_parent_abs_pos_list,
+                parent_idx,
                 ['question_encoding', 'question_mask', 'question_encoding_att_linear'],
             )
             _expand_encoding(
                 sketch_encoding_expanded,
-                new_hyp_parent_abs_pos_list,
+                parent_idx,
                 ['value', 'mask', 'var_time_step_mask']
             )
 
@@ -608,7 +699,7 @@ class SketchGuidedAgent(PGAgent):
         if not return_list:
             # rank completed hypothesis
             for env_name in completed_hyps.keys():
-                sorted_hyps = sorted(completed_hyps[env_name], key=lambda hyp: hyp.score, reverse=True)[:beam_size]
+                sorted_hyps = heapq.nlargest(beam_size, completed_hyps[env_name], key=lambda hyp: hyp.score)
                 completed_hyps[env_name] = [Sample(trajectory=Trajectory.from_environment(hyp.env), prob=hyp.score) for
                                             hyp in sorted_hyps]
 
@@ -17,6 +17,11 @@ class Sketch(object):
         self.operators = self.get_operators(program)
         self.prob = prob
 
+        # precomputed so per-timestep decoding loops can test
+        # `sketch.variable_slot_mask[t]` without a method dispatch per token
+        self.variable_slot_mask = tuple(
+            Sketch.is_variable_slot(token) for token in self.tokens)
+
     @staticmethod
     def program_to_sketch(program):
         sketch_tokens = []
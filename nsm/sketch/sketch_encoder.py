@@ -80,9 +80,8 @@ class SketchEncoder(nn.Module):
             sketch = sketches[i]
             tokens = sketch.tokens
             for t, token in enumerate(tokens):
-                is_slot = sketch.is_variable_slot(token)
                 token_id[i, t] = self.vocab[token]
-                variable_mask[i, t] = is_slot
+            variable_mask[i, :len(tokens)] = sketch.variable_slot_mask
             token_mask[i, :len(tokens)] = 1.
 
         token_id = torch.from_numpy(token_id).to(self.device)
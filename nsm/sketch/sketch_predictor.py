@@ -285,13 +285,16 @@ class SketchPredictor(nn.Module):
 
         return tensor_dict
 
-    def forward(self, env_contexts: List[Dict], sketches: List[Sketch]):
+    def forward(self, env_contexts: List[Dict], sketches: List[Sketch], context_encoding: Dict = None):
         prediction_target = self.to_tensor_dict(
             env_contexts, sketches)
 
         # (batch_size, sequence_len, encoding_size)
         # (batch_size, max_column_len, encoding_size)
-        src_encodings, column_encodings, decoder_init_state = self.encode(env_contexts)
+        # callers that already ran the underlying encoder on the same contexts
+        # can pass its output to skip the duplicate forward pass
+        src_encodings, column_encodings, decoder_init_state = self.encode(
+            env_contexts, context_encoding=context_encoding)
 
         tgt_sketch_token_ids = prediction_target['tgt_sketch_token_ids']
 
@@ -331,7 +334,7 @@ class SketchPredictor(nn.Module):
         ]
 
         sketches = [
-            Sketch(traj.program)
+            traj.get_sketch()
             for traj in trajectories
         ]
 
@@ -502,6 +505,7 @@ class SketchPredictor(nn.Module):
 
         return self.beam_search(env_context, src_encodings, column_encodings, decoder_init_state, beam_size=K)
 
+    @nn_util.inference_guard()
     def beam_search(
             self,
             examples: List[Dict],
@@ -515,7 +519,7 @@ class SketchPredictor(nn.Module):
         all_beams = [[['<s>']] for _ in examples]
         completed_hypotheses = [[] for _ in examples]
 
-        hyp_question_ids = torch.tensor(list(range(len(examples))), dtype=torch.long, device=self.device)
+        hyp_question_ids = list(range(len(examples)))
         hyp_scores = torch.zeros(len(examples), dtype=torch.float, device=self.device)
 
         # (batch_size, hidden_size)
@@ -532,12 +536,22 @@ class SketchPredictor(nn.Module):
 
             return selected_tensor_dict
 
+        exp_src_encodings = exp_column_encodings = None
+        exp_question_ids = None
+
         while t < max_decoding_time_step:
             t += 1
 
-            # (total_hyp_num, src_len, *)
-            exp_src_encodings = __select_encodings(src_encodings, hyp_question_ids)
-            exp_column_encodings = __select_encodings(column_encodings, hyp_question_ids)
+            # the per-hypothesis views of the encoder output only change when
+            # the beam composition changes; reuse the previously gathered
+            # (total_hyp_num, src_len, *) tensors otherwise instead of
+            # materializing fresh copies every step
+            if hyp_question_ids != exp_question_ids:
+                hyp_question_id_tensor = torch.tensor(
+                    hyp_question_ids, dtype=torch.long, device=self.device)
+                exp_src_encodings = __select_encodings(src_encodings, hyp_question_id_tensor)
+                exp_column_encodings = __select_encodings(column_encodings, hyp_question_id_tensor)
+                exp_question_ids = hyp_question_ids
 
             y_tm1 = torch.tensor(
                 [self.sketch_vocab[hyp[-1]]
@@ -579,16 +593,20 @@ class SketchPredictor(nn.Module):
                 beam_contiuating_cand_scores = contiuating_hyp_candidate_scores[beam_hyp_begin: beam_hyp_end]
                 live_hyp_num = beam_size - len(completed_hypotheses[q_idx])
 
-                top_cand_hyp_scores, top_cand_hyp_pos = torch.topk(beam_contiuating_cand_scores.view(-1), k=live_hyp_num)
-                prev_hyp_ids = top_cand_hyp_pos / len(self.sketch_vocab)
-                hyp_word_ids = top_cand_hyp_pos % len(self.sketch_vocab)
+                # rank order is irrelevant here: survivors all enter the next
+                # beam and completed hypotheses are sorted once at the end, so
+                # let topk skip its final sort
+                top_cand_hyp_scores, top_cand_hyp_pos = torch.topk(
+                    beam_contiuating_cand_scores.view(-1), k=live_hyp_num, sorted=False)
+                # move the top-k results to host in one transfer instead of
+                # calling `.item()` per candidate, which would sync with the
+                # device once for every beam entry
+                prev_hyp_ids = (top_cand_hyp_pos // len(self.sketch_vocab)).tolist()
+                hyp_word_ids = (top_cand_hyp_pos % len(self.sketch_vocab)).tolist()
+                top_cand_hyp_scores = top_cand_hyp_scores.tolist()
 
                 new_beam = []
                 for prev_hyp_id, hyp_word_id, cand_new_hyp_score in zip(prev_hyp_ids, hyp_word_ids, top_cand_hyp_scores):
-                    prev_hyp_id = prev_hyp_id.item()
-                    hyp_word_id = hyp_word_id.item()
-                    cand_new_hyp_score = cand_new_hyp_score.item()
-
                     hyp_word = self.sketch_id2token[hyp_word_id]
                     new_hyp_sent = beam[prev_hyp_id] + [hyp_word]
                     if hyp_word == '</s>':
@@ -612,7 +630,7 @@ class SketchPredictor(nn.Module):
 
             all_beams = new_beams
             hyp_scores = torch.tensor(new_hyp_scores, dtype=torch.float, device=self.device)
-            hyp_question_ids = torch.tensor(new_hyp_question_ids, dtype=torch.long, device=self.device)
+            hyp_question_ids = new_hyp_question_ids
 
         sketches = []
         for hyps in completed_hypotheses:
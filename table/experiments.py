@@ -305,9 +305,31 @@ def create_environments(
     table_representation_method,
     executor_type,
     max_n_mem=60, max_n_exp=3,
-    bert_tokenizer=None
+    bert_tokenizer=None,
+    num_workers=1
 ) -> List[QAProgrammingEnv]:
+    # each example is independent, so environment construction (executor API,
+    # interpreter setup, BERT annotation) can fan out over worker processes;
+    # the default stays serial since small datasets do not amortize the
+    # process start-up and the pickling of the finished environments
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            all_envs = pool.starmap(
+                create_environment,
+                [
+                    (example, table_dict[example['context']],
+                     table_representation_method, executor_type,
+                     max_n_mem, max_n_exp, bert_tokenizer)
+                    for example in dataset
+                ],
+                chunksize=64
+            )
+
+        return all_envs
+
     all_envs = []
+    # many examples share a table; build each table's executor API once
+    api_cache = {}
 
     for i, example in enumerate(dataset):
         if i % 100 == 0:
@@ -320,7 +342,8 @@ def create_environments(
             table_representation_method,
             executor_type,
             max_n_mem, max_n_exp,
-            bert_tokenizer
+            bert_tokenizer,
+            api_cache=api_cache
         )
 
         all_envs.append(env)
@@ -334,6 +357,7 @@ def create_environment(
         executor_type: str = 'wtq',
         max_n_mem: int = 60, max_n_exp: int = 3,
         bert_tokenizer: BertTokenizer = None,
+        api_cache: Dict = None,
 ) -> QAProgrammingEnv:
     if executor_type == 'wtq':
         score_fn = utils.wtq_score
@@ -346,8 +370,15 @@ def create_environment(
     else:
         raise ValueError('Unknown executor {}'.format(executor_type))
 
-    executor = executor_fn(table_kg)
-    api = executor.get_api()
+    # the API (type hierarchy, functions bound to the table's executor,
+    # constants) only depends on the table, so environments over the same
+    # table can share one instance
+    api = api_cache.get(table_kg['name']) if api_cache is not None else None
+    if api is None:
+        api = executor_fn(table_kg).get_api()
+        if api_cache is not None:
+            api_cache[table_kg['name']] = api
+
     type_hierarchy = api['type_hierarchy']
     func_dict = api['func_dict']
     constant_dict = api['constant_dict']